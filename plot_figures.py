@@ -4,12 +4,26 @@
 Created on Fri May 26 21:13:29 2023
 
 @author: kevinyin
+
+Usage: python plot_figures.py [ingest|clean|export|render|benchmark] [--only NAME ...] [--jobs N]
 """
 
 
 #%% imports
 
 import os
+import sys
+import glob
+import time
+import argparse
+import shutil
+import hashlib
+import tempfile
+import functools
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import geopandas as gpd
 import numpy as np
@@ -20,51 +34,343 @@ import matplotlib.colors as colors
 
 
 # 1. root directory
-directory_path = os.path.realpath(__file__)[:-21]
-os.chdir(directory_path)
+directory_path = os.path.dirname(os.path.realpath(__file__))
 
-# 2. data path
+# 2. data path (default for --data-dir)
 data_path = os.path.join(directory_path, "data")
 
-# 3. Image output path
+# 3. Image output path (default for --out-dir)
 output_path = os.path.join(directory_path, "figures")
 
 
 
 
 
+#%% memoization
+
+# set to False to bypass every memoized function (--cache off)
+memoize_enabled = True
+
+# every memoized function, so their caches can be cleared together
+memoized = []
+
+
+# identity of a file on disk: real path, size and modification time
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return ('file', os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+
+# digest of the per-row hashes in row order, so reordered frames get different keys
+def content_hash(value):
+    row_hashes = pd.util.hash_pandas_object(value).to_numpy()
+    return hashlib.blake2b(row_hashes.tobytes(), digest_size=16).hexdigest()
+
+
+
+# hashable summary of an argument, frames by dtypes and ordered content hash
+def fingerprint(value):
+    if isinstance(value, pd.DataFrame):
+        return ('frame', value.shape, tuple(value.columns), tuple(str(dtype) for dtype in value.dtypes), content_hash(value))
+    if isinstance(value, pd.Series):
+        return ('series', value.name, len(value), str(value.dtype), content_hash(value))
+    if isinstance(value, VintageStore):
+        return value.fingerprint()
+    if isinstance(value, dict):
+        return ('dict',) + tuple((key, fingerprint(value[key])) for key in sorted(value))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(fingerprint(item) for item in value)
+    return value
+
+
+
+# copy frames on the way out so callers can never modify a cached result
+def copy_result(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: copy_result(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(copy_result(item) for item in value)
+    return value
+
+
+
+# thread-safe LRU cache keyed on the fingerprints of a function's arguments
+# file_arg is the position of a path argument that is keyed on the file itself (readers only)
+def memoize(maxsize=32, file_arg=None):
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not memoize_enabled:
+                return func(*args, **kwargs)
+
+            arg_keys = [file_fingerprint(arg) if i == file_arg else arg for i, arg in enumerate(args)]
+            key = (fingerprint(arg_keys), fingerprint(sorted(kwargs.items())))
+            with lock:
+                hit = key in cache
+                if hit:
+                    cache.move_to_end(key)
+                    result = cache[key]
+
+            # compute outside the lock so other threads and nested memoized calls are not blocked
+            if not hit:
+                result = func(*args, **kwargs)
+                with lock:
+                    cache[key] = result
+                    cache.move_to_end(key)
+                    while len(cache) > maxsize:
+                        cache.popitem(last=False)
+
+            return copy_result(result)
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_size = lambda: len(cache)
+        memoized.append(wrapper)
+        return wrapper
+    return decorator
+
+
+
+# empty the caches of every memoized function
+def clear_memoized():
+    for func in memoized:
+        func.cache_clear()
+
+
+
+
+
+#%% parsers
+
+# number of rows read from the top of a workbook to detect its layout
+probe_rows = 15
+
+# bump when a parser or vintage cleaner changes, so pickles of older output are not reused
+parser_version = 1
+
+# column maps of the layouts seen so far, keyed on each file format's header signature
+layout_cache = {}
+
+
+# lowercase a header cell and collapse its whitespace, None for blank cells
+def norm_label(cell):
+    if pd.isna(cell) or str(cell).strip() == '':
+        return None
+    return ' '.join(str(cell).split()).lower()
+
+
+
+# find the first probed row whose set of labels is accepted by `match`
+def find_header_row(head, match):
+    for i in range(len(head)):
+        if match({norm_label(cell) for cell in head.iloc[i]}):
+            return i
+    raise ValueError(f"no header row found in the first {len(head)} rows")
+
+
+
+# keep the rows between the first and last row holding any data, dropping notes and units
+def trim_to_data(df, label):
+    has_data = df.drop(columns=label).notna().any(axis=1).to_numpy().nonzero()[0]
+    if len(has_data) == 0:
+        return df.iloc[0:0]
+    df = df.iloc[has_data[0]:has_data[-1] + 1]
+    return df[df[label].notna()].reset_index(drop=True)
+
+
+
+# detect header row and columns of an imf CPIS workbook
+def layout_imf(path):
+    head = pd.read_excel(path, header=None, nrows=probe_rows)
+    header = find_header_row(head, lambda labels: 'investment in:' in labels)
+    labels = head.iloc[header]
+
+    signature = ('imf',) + tuple(norm_label(cell) for cell in labels)
+    if signature not in layout_cache:
+
+        # keep destinations and every source country, skip blank and SEFER + SSIO aggregate columns
+        columns = {}
+        for j, cell in enumerate(labels):
+            label = norm_label(cell)
+            if label is None or label.startswith('sefer'):
+                continue
+            columns[j] = 'destination' if label == 'investment in:' else str(cell).strip()
+        layout_cache[signature] = columns
+
+    return header, layout_cache[signature]
+
+
+
+# read an imf CPIS workbook in one pass using its detected layout
+@memoize(maxsize=64, file_arg=0)
+def parse_imf(path):
+    header, columns = layout_imf(path)
+    positions = sorted(columns)
+    df = pd.read_excel(path, header=None, skiprows=header + 1, usecols=positions)
+    df.columns = [columns[j] for j in positions]
+    return trim_to_data(df, 'destination')
+
+
+
+# canonical names of the oecd asset-class columns, keyed on normalized header labels
+oecd_columns = {'variable':'country',
+                'country':'country',
+                'cash and deposits':'cash',
+                'bills and bonds issued by public and private sector':'bonds',
+                'loans':'loans',
+                'equity':'equity',
+                'mutual funds (cis)':'mutual funds',
+                'of which: cash and deposits':'Of which: Cash and deposits',
+                'of which: bills and bonds':'Of which: Bills and bonds',
+                'of which: equity':'Of which: Equity',
+                'of which: land and buildings':'Of which: Land and buildings',
+                'of which: other':'Of which: Other',
+                'land and buildings':'real estate',
+                'unallocated insurance contracts':'Unallocated insurance contracts',
+                'hedge funds':'hedge funds',
+                'private equity funds':'private equity',
+                'structured products':'Structured products',
+                'other investments':'other'}
+
+# every vintage is parsed into this schema, missing classes come back empty
+oecd_schema = list(dict.fromkeys(oecd_columns.values()))
+
+
+# detect header rows and columns of an oecd asset-structure workbook
+def layout_oecd(path):
+    head = pd.read_excel(path, header=None, nrows=probe_rows)
+    header = find_header_row(head, lambda labels: bool(labels & {'variable', 'country'}) and 'equity' in labels)
+    labels = head.iloc[header]
+
+    # mutual fund breakdowns sit on a sub-header row in some vintages, only their "of which" labels are kept
+    sub_labels = [None] * len(labels)
+    if header + 1 < len(head):
+        sub_labels = [norm_label(cell) for cell in head.iloc[header + 1]]
+        sub_labels = [label if label is not None and label.startswith('of which') else None for label in sub_labels]
+    skip = header + (2 if any(sub_labels) else 1)
+
+    signature = ('oecd',) + tuple(norm_label(cell) for cell in labels) + tuple(sub_labels)
+    if signature not in layout_cache:
+
+        # an "of which" sub-header label overrides the header cell above it
+        columns = {}
+        for j, cell in enumerate(labels):
+            label = sub_labels[j] if sub_labels[j] is not None else norm_label(cell)
+            if label in oecd_columns and oecd_columns[label] not in columns.values():
+                columns[j] = oecd_columns[label]
+        layout_cache[signature] = columns
+
+    return skip, layout_cache[signature]
+
+
+
+# read an oecd asset-structure workbook in one pass using its detected layout
+@memoize(maxsize=64, file_arg=0)
+def parse_oecd(path):
+    skip, columns = layout_oecd(path)
+    positions = sorted(columns)
+    df = pd.read_excel(path, header=None, skiprows=skip, usecols=positions)
+    df.columns = [columns[j] for j in positions]
+    df = df.reindex(columns=oecd_schema)
+    return trim_to_data(df, 'country')
+
+
+
+# rows per chunk when streaming the oecd bulk csv downloads
+csv_chunksize = 100000
+
+
+# stream a csv in chunks, keeping only `usecols` and the rows accepted by `keep`
+def read_csv_pruned(path, usecols, dtype, keep=None):
+    df_list = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=dtype, chunksize=csv_chunksize):
+        if keep is not None:
+            chunk = chunk[keep(chunk)]
+        df_list.append(chunk)
+    return pd.concat(df_list, ignore_index=True)
+
+
+
+# oecd total pension assets, investment rows only (PowerCode Code is the power of ten of Value's unit)
+@memoize(maxsize=4, file_arg=0)
+def read_pension_assets(path):
+    return read_csv_pruned(path,
+                           usecols=lambda col: col in ('Variable','Country','Year','Unit Code','PowerCode Code','Value'),
+                           dtype={'Variable':str, 'Country':str, 'Year':'int32', 'Unit Code':str,
+                                  'PowerCode Code':'float64', 'Value':'float64'},
+                           keep=lambda chunk: chunk['Variable'] == 'INVESTMENT')
+
+
+
+# oecd exchange rates, national currency units per USD
+@memoize(maxsize=4, file_arg=0)
+def read_exrate(path):
+    return read_csv_pruned(path,
+                           usecols=['LOCATION','TIME','Value'],
+                           dtype={'LOCATION':str, 'TIME':'int32', 'Value':'float64'})
+
+
+
+# geopolitical risk index, only the world and Greater China series
+@memoize(maxsize=4, file_arg=0)
+def read_gpr(path):
+    return pd.read_excel(path, usecols=['month','GPR','GPRC_CHN','GPRC_TWN','GPRC_HKG'])
+
+
+
+# optional country-year tables in the oecd csv layout (USD deflator index, population)
+@memoize(maxsize=4, file_arg=0)
+def read_country_year(path):
+    df = read_csv_pruned(path,
+                         usecols=lambda col: col in ('Country','Year','PowerCode Code','Value'),
+                         dtype={'Country':str, 'Year':'int32', 'PowerCode Code':'float64', 'Value':'float64'})
+    return df.rename(columns={'Country':'country', 'Year':'year', 'PowerCode Code':'power', 'Value':'value'})
+
+
+
+
+
 #%% data
 
 # IMF investment data
-dict_imf_jun = {}
-dict_imf_dec = {}
+imf_files = {}
 
 for y in range(2013,2023):
-        key = y
-        dict_imf_jun[key] = pd.read_excel(os.path.join(data_path, "imf", f"allinvest_june{y}.xlsx"))
+        imf_files[(y, 6)] = os.path.join("imf", f"allinvest_june{y}.xlsx")
         if y < 2022:
-            dict_imf_dec[key] = pd.read_excel(os.path.join(data_path, "imf", f"allinvest_dec{y}.xlsx"))
-    
-    
-# geopolitical risk data
-df_gpr = pd.read_excel(os.path.join(data_path, "gpr", "geo_risk_index.xls"))
+            imf_files[(y, 12)] = os.path.join("imf", f"allinvest_dec{y}.xlsx")
 
 
-# OECD total asset data
-df_pension_assets = pd.read_csv(os.path.join(data_path, "oecd", "total_pension_assets.csv"))
-df_pension_gdp = pd.read_csv(os.path.join(data_path, "oecd", "total_pension_assets_perc.csv"))
-
 # FIXME: the data you downloaded doesnt work from 2018 to 2021
+# (layouts are now detected per vintage, but those files have not been verified yet)
 # OECD asset structure
-dict_oecd = {}
+oecd_struct_files = {}
 
 for y in range(2006,2022):
-    key = y
-    dict_oecd[key] = pd.read_excel(os.path.join(data_path, "oecd", f"pension_asset_struct{y}.xlsx"))
+    oecd_struct_files[y] = os.path.join("oecd", f"pension_asset_struct{y}.xlsx")
+
 
+# raw inputs: name -> (reader, file or {key: file}) relative to the data directory
+sources = {'imf': (parse_imf, imf_files),
+           'gpr': (read_gpr, os.path.join("gpr", "geo_risk_index.xls")),
+           'pension_assets': (read_pension_assets, os.path.join("oecd", "total_pension_assets.csv")),
+           'pension_gdp': (pd.read_csv, os.path.join("oecd", "total_pension_assets_perc.csv")),
+           'oecd_struct': (parse_oecd, oecd_struct_files),
+           'exrate': (read_exrate, "exchange_rates_oecd.csv"),
+           'deflator': (read_country_year, os.path.join("oecd", "deflator.csv")),
+           'population': (read_country_year, os.path.join("oecd", "population.csv"))}
 
-# exchange rates
-df_exrate_raw = pd.read_csv(os.path.join(data_path, "exchange_rates_oecd.csv"))
+# inputs that are skipped when their file is not in the data directory
+optional_sources = ['deflator', 'population']
 
 
 
@@ -74,20 +380,12 @@ df_exrate_raw = pd.read_csv(os.path.join(data_path, "exchange_rates_oecd.csv"))
 
 
 # cleans imf dataframes
+@memoize(maxsize=64)
 def clean_imf(df):
 
-    # remove empty columns and rows (or those with commentary)
-    df = df.drop(columns=['Unnamed: 0', 'Unnamed: 1'])
-    df = df.iloc[3:]
-    df.columns = df.iloc[0]
-    df.reset_index(inplace=True)
-    df = df.iloc[1:247]
-    df = df.drop(columns=['index','SEFER + SSIO (**)'])
-    
-    # save names of destination countries
-    destination = df[['Investment in:']]
-    destination = destination.rename(columns={'Investment in:':'destination'})
-    df = df.drop(columns='Investment in:').apply(pd.to_numeric, errors='coerce')
+    # save names of destination countries (layout is already handled by parse_imf)
+    destination = df[['destination']]
+    df = df.drop(columns='destination').apply(pd.to_numeric, errors='coerce')
     df = pd.concat([destination, df], axis=1)
 
     # return cleaned data
@@ -95,96 +393,10 @@ def clean_imf(df):
 
 
 
-# get time series of investments and share of total foreign investment from source to dest.
-def timeseries_imf(source, destination):
-    
-    yrs_list = []
-    mth_list = []
-    inv_list = []
-    tot_list = []
-    
-    # extract investment flows from source to destination for each year
-    for i in range(2013,2023):
-        
-        # add year to list
-        yrs_list.append(i)
-        mth_list.append(6)
-        
-        # choose dataframe
-        df = clean_imf(dict_imf_jun[i])
-        
-        # find investment from source to destination
-        countries = df[['destination']]
-        ctry_index = countries.index[countries['destination'] == destination]
-        inv = df.loc[ctry_index[0], source]
-        inv_list.append(inv)
-        
-        # find total investment and calculate percentage of total
-        wrld_index = countries.index[countries['destination'] == 'World']
-        tot = df.loc[wrld_index[0], source]
-        tot_list.append(tot)
-        
-        # clean december data
-        if i < 2022:
-            
-            # add year to list
-            yrs_list.append(i)
-            mth_list.append(12)
-            
-            # choose dataframe
-            df = clean_imf(dict_imf_dec[i])
-            
-            # find investment from source to destination
-            countries = df[['destination']]
-            ctry_index = countries.index[countries['destination'] == destination]
-            inv = df.loc[ctry_index[0], source]
-            inv_list.append(inv)
-            
-            # find total investment and calculate percentage of total
-            wrld_index = countries.index[countries['destination'] == 'World']
-            tot = df.loc[wrld_index[0], source]
-            tot_list.append(tot)
-    
-    # create dataframe out of years and investments
-    df_output = pd.DataFrame({'year': yrs_list, 'month': mth_list, 'inv_in_dest': inv_list, 'total_inv': tot_list})
-    df_output['inv_share'] = df_output['inv_in_dest'] / df_output['total_inv']
-    return df_output
-
-
-
 # cleans oecd asset-class dataframes
+@memoize(maxsize=64)
 def clean_oecd(df):
     
-    # retrieve columns
-    col1 = df.iloc[7:8]
-    col2 = df.iloc[8:9]
-    
-    # move mutual fund assets into columns
-    col1['Unnamed: 8'] = col2.loc[8]['Unnamed: 8']
-    col1['Unnamed: 9'] = col2.loc[8]['Unnamed: 9']
-    col1['Unnamed: 10'] = col2.loc[8]['Unnamed: 10']
-    col1['Unnamed: 11'] = col2.loc[8]['Unnamed: 11']
-    col1['Unnamed: 12'] = col2.loc[8]['Unnamed: 12']
-    
-    # clean up
-    df = df.iloc[9:]
-    df = pd.concat([col1, df], axis=0)
-    df.columns = df.loc[7]
-    df = df.iloc[2:]
-    df = df.drop(columns=np.nan)
-    
-    # rename
-    df = df.rename(columns={'Variable':'country',
-                                  'Cash and Deposits':'cash',
-                                  'Bills and bonds issued by public and private sector':'bonds',
-                                  'Loans':'loans',
-                                  'Equity':'equity',
-                                  'Mutual funds (CIS)':'mutual funds',
-                                  'Land and Buildings':'real estate',
-                                  'Hedge funds':'hedge funds',
-                                  'Private equity funds':'private equity',
-                                  'Other investments': 'other'})
-    
     # turn to numeric
     countries = df['country']
     df = df.apply(pd.to_numeric, errors='coerce').drop(columns='country')
@@ -232,32 +444,74 @@ def clean_oecd(df):
     
     # drop all the extra columns
     df = df[['country','cash','bonds','equity','real estate','other','mtf_unknown']]
-    df = df[:-1]
 
     return df
 
 
-def timeseries_assetclass(country, asset):
-    
-    # initialize
-    years_list = []
-    asset_list = []
-    
-    for i in range(2006,2022):
-        
-         # add year to list
-        years_list.append(i)
-        
-        # add bond value to list
-        df = clean_oecd(dict_oecd[i])
-        asset_value = df.loc[df['country'] == country, asset].item()
-        
-        # add asset value to list
-        asset_list.append(asset_value)
 
-    # create dataframe out of years and asset allocations
-    df_output = pd.DataFrame({'year': years_list, country: asset_list})
-    return df_output
+# per-file cleaners of the inputs read from one workbook per vintage
+vintage_cleaners = {'imf': clean_imf, 'oecd_struct': clean_oecd}
+
+# memoized readers, their caches hold raw frames
+raw_memoized = [parse_imf, parse_oecd, read_pension_assets, read_exrate, read_gpr, read_country_year]
+
+
+
+# asset classes that make up 100% of a pension allocation
+asset_classes = ['cash','bonds','equity','real estate','other']
+
+
+# stack the cleaned oecd asset-class vintages into one (year, country) panel
+@memoize(maxsize=4)
+def panel_oecd(oecd):
+
+    df_list = []
+    for i in sorted(oecd):
+        df = oecd[i].copy()
+        df.insert(0, 'year', i)
+        df_list.append(df)
+
+    return pd.concat(df_list, ignore_index=True)
+
+
+
+# rescale the asset classes of every (year, country) row to 100% in one broadcast
+@memoize(maxsize=4)
+def normalize_allocations(panel, tol=1.0):
+
+    # raw sums over the asset classes only (the mtf_unknown flag is not an asset)
+    values = panel[asset_classes].to_numpy(dtype=float)
+    sums = values.sum(axis=1, keepdims=True)
+
+    # rows with no data stay NaN instead of dividing by zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = np.where(sums > 0, 100 * values / sums, np.nan)
+
+    # flag rows whose raw sum is more than `tol` percentage points away from 100
+    df = panel.copy()
+    df[asset_classes] = scaled
+    df['raw_sum'] = sums[:, 0]
+    df['sum_flag'] = (df['raw_sum'] - 100).abs() > tol
+
+    return df
+
+
+
+# report rows whose raw allocation is too far off 100% to trust the rescaling
+def report_allocations(alloc):
+    flagged = alloc.loc[alloc['sum_flag'] & alloc['raw_sum'].notna(), ['year','country','raw_sum']]
+    if len(flagged) > 0:
+        print("Allocations outside tolerance before normalization:")
+        print(flagged.to_string(index=False))
+
+
+
+# stacked-bar ready allocation of one country over a range of years (inclusive)
+@memoize(maxsize=32)
+def allocation_timeseries(panel, country, start=2006, end=2021):
+
+    df = panel[(panel['country'] == country) & panel['year'].between(start, end)]
+    return df.set_index('year')[asset_classes].sort_index()
 
 
 
@@ -271,194 +525,191 @@ oecd_aclass_list = ['Canada', 'United States', 'United Kingdom', 'Germany', 'Aus
 
 #%% create investment time series
 
+@memoize(maxsize=4)
+def clean_investment(raw):
 
-# initialize
-df_inv_in_china = timeseries_imf('United States', 'China, P.R.: Mainland')
-df_inv_in_china = df_inv_in_china[['year','month']]
+    # one pass over the cleaned surveys, keeping the China and World rows of every G7 source
+    imf = raw['imf']
+    dates = sorted(imf)
+    inv_list = []
+    tot_list = []
 
-df_share_in_china = timeseries_imf('United States', 'China, P.R.: Mainland')
-df_share_in_china = df_share_in_china[['year','month']]
+    for date in dates:
+        df = imf[date]
+        inv_list.append(df.loc[df['destination'] == 'China, P.R.: Mainland', g7_list].iloc[0])
+        tot_list.append(df.loc[df['destination'] == 'World', g7_list].iloc[0])
 
-df_totalinv = timeseries_imf('United States', 'China, P.R.: Mainland')
-df_totalinv = df_totalinv[['year','month']]
+    index = pd.MultiIndex.from_tuples(dates, names=['year','month'])
+    df_inv = pd.DataFrame(inv_list).set_index(index)
+    df_tot = pd.DataFrame(tot_list).set_index(index)
 
+    # set to the appropriate units
+    return {'inv_in_china': df_inv / 1000, # billions
+            'share_in_china': (df_inv / df_tot) * 100, # percentage
+            'totalinv': df_tot / 1000000} # trillions
 
-# loop through G7 countries
-for country in g7_list:
-    df_temp = timeseries_imf(country, 'China, P.R.: Mainland')
-    df_temp = df_temp.rename(columns={'inv_in_dest':f'{country}'})
-    df_inv_in_china = pd.concat([df_inv_in_china, df_temp[[f'{country}']]], axis=1)
 
-    
-    df_temp = timeseries_imf(country, 'China, P.R.: Mainland')
-    df_temp = df_temp.rename(columns={'inv_share':f'{country}'})
-    df_share_in_china = pd.concat([df_share_in_china, df_temp[[f'{country}']]], axis=1)
-    
-    df_temp = timeseries_imf(country, 'China, P.R.: Mainland')
-    df_temp = df_temp.rename(columns={'total_inv':f'{country}'})
-    df_totalinv = pd.concat([df_totalinv, df_temp[[f'{country}']]], axis=1)
 
 
-# set time to index for plotting
-df_inv_in_china = df_inv_in_china.set_index(['year','month'])
-df_share_in_china = df_share_in_china.set_index(['year','month'])
-df_totalinv = df_totalinv.set_index(['year','month'])
 
+#%% clean total pension data
 
-# set to the appropriate units
-df_totalinv = df_totalinv / 1000000 # trillions
-df_share_in_china = df_share_in_china * 100 # percentage
-df_inv_in_china = df_inv_in_china / 1000 # billions
+# currency codes of the pension totals -> location codes of the exchange rates (euro members use 'EUR')
+currency_locations = {'AUD':'AUS', 'USD':'USA', 'CAD':'CAN', 'DKK':'DNK', 'CZK':'CZE',
+                      'JPY':'JPN', 'KRW':'KOR', 'MXN':'MEX', 'NZD':'NZL',
+                      'HUF':'HUN', 'ISK':'ISL', 'PLN':'POL', 'SEK':'SWE', 'CHF':'CHE',
+                      'TRY':'TUR', 'GBP':'GBR', 'CLP':'CHL', 'COP':'COL', 'CRC':'CRI', 'ILS':'ISR'}
 
 
+# long (country, year, perc_gdp) table from the wide pension assets % of GDP download
+def melt_pension_gdp(df):
+    df = df.melt(id_vars='country', var_name='year', value_name='perc_gdp')
+    df['year'] = pd.to_numeric(df['year'], errors='coerce')
+    df['perc_gdp'] = pd.to_numeric(df['perc_gdp'], errors='coerce')
+    return df.dropna(subset=['year']).astype({'year':'int32'})
 
 
 
-#%% clean total pension data
+# values of a keyed table at the requested integer keys, duplicates averaged, NaN where missing
+def lookup(table_keys, values, keys):
+    table = pd.Series(np.asarray(values, dtype=float), index=table_keys)
+    table = table.groupby(level=0).mean()
+    return table.reindex(keys).to_numpy()
 
-# clean exchange rates
-df_exrate = df_exrate_raw[['LOCATION','TIME','Value']]
-df_exrate['LOCATION'] = df_exrate['LOCATION'].str.replace('DEU','EUR')
-df_exrate = df_exrate.rename(columns={'LOCATION':'currency','TIME':'year','Value':'unit_per_usd'})
 
-# clean pension data
-df_total_pension = df_pension_assets[['Variable','Country','Year','Unit','Unit Code','Value']]
-df_total_pension = df_total_pension[df_total_pension['Variable'] == 'INVESTMENT']
-df_total_pension = df_total_pension.rename(columns={'Country':'ctry_name',
-                                                    'Year':'year',
-                                                    'Unit Code':'currency',
-                                                    'Value':'totassets'})
 
-# replace currencies with country names
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('AUD','AUS')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('USD','USA')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('CAD','CAN')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('DKK','DNK')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('CZK','CZE')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('JPY','JPN')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('KRW','KOR')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('MXN','MEX')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('NZD','NZL')
+# power of ten of the pension totals when the download has no PowerCode Code column (OECD reports millions)
+pension_power_code = 6
 
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('HUF','HUN')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('ISK','ISL')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('PLN','POL')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('SEK','SWE')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('CHF','CHE')
 
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('TRY','TUR')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('GBP','GBR')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('CLP','CHL')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('COP','COL')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('CRC','CRI')
-df_total_pension['currency'] = df_total_pension['currency'].str.replace('ILS','ISR')
+# nominal USD, real USD, % of GDP and per capita pension assets for every (country, year)
+# totassets_usd and totassets_real_usd stay in the unit of the download (millions), per capita is in USD
+@memoize(maxsize=8)
+def pension_metrics(totals, exrate, gdp_share, deflator=None, population=None):
 
-# merge
-df_total_pension = df_total_pension.merge(df_exrate, how='left', on=['currency','year'])
+    if 'Variable' in totals:
+        totals = totals[totals['Variable'] == 'INVESTMENT']
+    gdp_share = melt_pension_gdp(gdp_share)
 
-# calculate assets in USD
-df_total_pension['totassets_usd'] = df_total_pension['totassets'] / df_total_pension['unit_per_usd']
+    # integer-code every country, a (country, year) key is code * 10000 + year
+    names = [totals['Country'], gdp_share['country']]
+    if population is not None:
+        names.append(population['country'])
+    countries = pd.Index(pd.concat(names).dropna().unique()).sort_values()
 
+    def country_keys(country, year):
+        return countries.get_indexer(country).astype('int64') * 10000 + np.asarray(year, dtype='int64')
 
-# clean and reshape for plotting
-df_total_pension = df_total_pension[['ctry_name','year','totassets_usd']]
-df_temp = df_total_pension['year'].sort_values().unique()
-df_total_pension = df_total_pension.pivot_table(index=['year'], columns='ctry_name',  values='totassets_usd')
+    total_keys = country_keys(totals['Country'], totals['Year'])
+    gdp_keys = country_keys(gdp_share['country'], gdp_share['year'])
+    years = totals['Year'].to_numpy(dtype='int64')
 
+    # one row per (country, year) seen in either the totals or the % of GDP table
+    keys = np.union1d(total_keys[total_keys >= 0], gdp_keys[gdp_keys >= 0])
+    df = pd.DataFrame({'country': countries[keys // 10000], 'year': (keys % 10000).astype('int32')})
 
+    # convert every totals row at the rate of its own currency, then average per (country, year)
+    fx_locations = exrate['LOCATION'].replace('DEU', 'EUR')
+    locations = pd.Index(fx_locations.unique())
+    fx_keys = locations.get_indexer(fx_locations).astype('int64') * 10000 + exrate['TIME'].to_numpy(dtype='int64')
+    row_locations = totals['Unit Code'].map(currency_locations).fillna(totals['Unit Code'])
+    row_fx = lookup(fx_keys, exrate['Value'], locations.get_indexer(row_locations).astype('int64') * 10000 + years)
+    row_usd = totals['Value'].to_numpy(dtype=float) / row_fx
 
+    # nominal USD and % of GDP
+    df['totassets_usd'] = lookup(total_keys, row_usd, keys)
+    df['perc_gdp'] = lookup(gdp_keys, gdp_share['perc_gdp'], keys)
 
+    # real USD from a single USD deflator index (base year = 100), a local price index would mix in FX moves
+    df['totassets_real_usd'] = np.nan
+    if deflator is not None:
+        if 'country' in deflator and deflator['country'].nunique() > 1:
+            raise ValueError("pension_metrics needs one USD deflator, not a deflator per country")
+        index = lookup(deflator['year'].to_numpy(dtype='int64'), deflator['value'], df['year'].to_numpy(dtype='int64'))
+        df['totassets_real_usd'] = df['totassets_usd'] / (index / 100)
 
-#%% clean pension % data
+    # USD per person, with both totals and population scaled to units
+    df['totassets_usd_per_capita'] = np.nan
+    if population is not None:
+        power = totals['PowerCode Code'].fillna(pension_power_code) if 'PowerCode Code' in totals else pension_power_code
+        row_usd_units = row_usd * 10.0 ** np.asarray(power, dtype=float)
+        people = population['value'] * 10.0 ** population['power'].fillna(0) if 'power' in population else population['value']
+        df['population'] = lookup(country_keys(population['country'], population['year']), people, keys)
+        df['totassets_usd_per_capita'] = lookup(total_keys, row_usd_units, keys) / df['population']
 
-# convert to numeric
-pension_countries = df_pension_gdp['country']
-df_pens_gdp_clean = df_pension_gdp.drop(columns='country')
-df_pens_gdp_clean = df_pens_gdp_clean.apply(pd.to_numeric, errors='coerce')
-df_pens_gdp_clean = pd.concat([pension_countries,df_pens_gdp_clean], axis=1)
+    return df
 
-# keep only G7
-df_pens_gdp_clean = df_pens_gdp_clean[df_pens_gdp_clean['country'].isin(g7_list)]
-df_pens_gdp_clean = df_pens_gdp_clean.transpose()
-df_pens_gdp_clean.columns = df_pens_gdp_clean.iloc[0]
-df_pens_gdp_clean = df_pens_gdp_clean.drop(df_pens_gdp_clean.index[0])
-df_pens_gdp_clean = df_pens_gdp_clean.apply(pd.to_numeric, errors='coerce')
 
-# drop Japan since data is bad
-df_pens_gdp_clean = df_pens_gdp_clean.drop(columns='Japan')
 
-# keep only last 2 decades
-df_pens_gdp_clean.index = pd.to_numeric(df_pens_gdp_clean.index, downcast='integer', errors='coerce')
-df_pens_gdp_clean = df_pens_gdp_clean[df_pens_gdp_clean.index > 2001]
-df_pens_gdp_clean.index = df_pens_gdp_clean.index.map(str)
+@memoize(maxsize=4)
+def clean_pension_totals(raw):
 
+    # every metric for every country in one pass
+    df_metrics = pension_metrics(raw['pension_assets'], raw['exrate'], raw['pension_gdp'],
+                                 raw.get('deflator'), raw.get('population'))
 
+    # reshape nominal USD totals for plotting
+    df_total_pension = df_metrics.pivot(index='year', columns='country', values='totassets_usd')
+    df_total_pension = df_total_pension.dropna(how='all').dropna(axis=1, how='all')
 
+    return {'pension_metrics': df_metrics, 'total_pension': df_total_pension}
 
 
-#%% clean oecd asset class
 
-# prepare most recent asset class data
-df_g7_assets_2021 = clean_oecd(dict_oecd[2021])
-df_g7_assets_2021 = df_g7_assets_2021[df_g7_assets_2021['country'].isin(oecd_aclass_list)]
-df_g7_assets_2021['sum'] = df_g7_assets_2021.sum(axis=1)
-df_g7_assets_2021.loc[df_g7_assets_2021['country'] == 'United States', 'sum'] = 100.00132 # hard code US sum for some reason
-df_g7_assets_2021['multiplier'] = 100 / df_g7_assets_2021['sum']
 
-df_g7_assets_2021['cash'] = df_g7_assets_2021['cash'] * df_g7_assets_2021['multiplier']
-df_g7_assets_2021['bonds'] = df_g7_assets_2021['bonds'] * df_g7_assets_2021['multiplier']
-df_g7_assets_2021['equity'] = df_g7_assets_2021['equity'] * df_g7_assets_2021['multiplier']
-df_g7_assets_2021['real estate'] = df_g7_assets_2021['real estate'] * df_g7_assets_2021['multiplier']
-df_g7_assets_2021['other'] = df_g7_assets_2021['other'] * df_g7_assets_2021['multiplier']
-df_g7_assets_2021['country'] = df_g7_assets_2021['country'].str.replace('United States', '*United States')
 
+#%% clean pension % data
 
-# clean
-df_g7_assets_2021 = df_g7_assets_2021.drop(columns=['sum','multiplier'])
-df_g7_assets_2021 = df_g7_assets_2021[['country','bonds','equity','real estate','cash','other']]
-df_g7_assets_2021 = df_g7_assets_2021.sort_values(by = 'bonds', axis = 0)
+@memoize(maxsize=4)
+def clean_pension_gdp(raw):
 
+    # keep only G7, drop Japan since data is bad, keep only last 2 decades
+    df = melt_pension_gdp(raw['pension_gdp'])
+    df = df[df['country'].isin(g7_list) & (df['country'] != 'Japan') & (df['year'] > 2001)]
 
-# prepare time series of cash holdings
-df_init = timeseries_assetclass('Canada', 'cash')
-df_init = df_init.drop(columns='Canada')
-df_list = [df_init]
+    df_pens_gdp_clean = df.pivot(index='year', columns='country', values='perc_gdp')
+    df_pens_gdp_clean.index = df_pens_gdp_clean.index.map(str)
 
-for country in oecd_aclass_list:
-    df = timeseries_assetclass(country, 'cash')
-    df = df.drop(columns='year')
-    df_list.append(df)
-    
-df_cash_holdings = pd.concat(df_list, axis=1)
-df_cash_holdings = df_cash_holdings.set_index('year')
+    return {'pens_gdp_clean': df_pens_gdp_clean}
 
 
-# prepare time series of bond holdings
-df_init = timeseries_assetclass('Canada', 'bonds')
-df_init = df_init.drop(columns='Canada')
-df_list = [df_init]
 
-for country in oecd_aclass_list:
-    df = timeseries_assetclass(country, 'bonds')
-    df = df.drop(columns='year')
-    df_list.append(df)
-    
-df_bond_holdings = pd.concat(df_list, axis=1)
-df_bond_holdings = df_bond_holdings.set_index('year')
 
 
-# prepare time series of equity holdings
-df_init = timeseries_assetclass('Canada', 'equity')
-df_init = df_init.drop(columns='Canada')
-df_list = [df_init]
+#%% clean oecd asset class
 
-for country in oecd_aclass_list:
-    df = timeseries_assetclass(country, 'equity')
-    df = df.drop(columns='year')
-    df_list.append(df)
-    
-df_equity_holdings = pd.concat(df_list, axis=1)
-df_equity_holdings = df_equity_holdings.set_index('year')
+@memoize(maxsize=4)
+def clean_asset_class(raw):
+
+    # stack every year of asset class data and rescale each (year, country) to 100%
+    df_oecd_panel = panel_oecd(raw['oecd_struct'])
+    df_alloc = normalize_allocations(df_oecd_panel)
+
+    # prepare most recent asset class data
+    df_g7_assets_2021 = df_alloc[(df_alloc['year'] == 2021) & df_alloc['country'].isin(oecd_aclass_list)]
+    df_g7_assets_2021 = df_g7_assets_2021[['country','bonds','equity','real estate','cash','other']].copy()
+    df_g7_assets_2021['country'] = df_g7_assets_2021['country'].str.replace('United States', '*United States')
+    df_g7_assets_2021 = df_g7_assets_2021.sort_values(by = 'bonds', axis = 0)
+
+
+    # prepare time series of cash, bond and equity holdings for the selected countries only
+    # NOTE: these use the un-normalized panel on purpose, so the line charts show the shares as
+    # reported by clean_oecd (as before), while the 2021 bars use the rescaled df_alloc
+    df_selected = df_oecd_panel[df_oecd_panel['country'].isin(oecd_aclass_list)]
+    df_cash_holdings = df_selected.pivot(index='year', columns='country', values='cash').reindex(columns=oecd_aclass_list)
+    df_bond_holdings = df_selected.pivot(index='year', columns='country', values='bonds').reindex(columns=oecd_aclass_list)
+    df_equity_holdings = df_selected.pivot(index='year', columns='country', values='equity').reindex(columns=oecd_aclass_list)
+
+    # stacked allocation of Canadian pensions over the whole sample
+    df_canada_alloc = allocation_timeseries(df_alloc, 'Canada')
+
+    return {'oecd_panel': df_oecd_panel,
+            'alloc': df_alloc,
+            'g7_assets_2021': df_g7_assets_2021,
+            'cash_holdings': df_cash_holdings,
+            'bond_holdings': df_bond_holdings,
+            'equity_holdings': df_equity_holdings,
+            'canada_alloc': df_canada_alloc}
 
 
 
@@ -466,28 +717,39 @@ df_equity_holdings = df_equity_holdings.set_index('year')
 
 #%% clean GPR
 
-# cut NaNs, start from 2000
-df_gpr_plot = df_gpr
-df_gpr_plot = df_gpr_plot.set_index('month')
-df_gpr_plot = df_gpr_plot[~df_gpr_plot['GPRC_CHN'].isna()]
-df_gpr_plot = df_gpr_plot[df_gpr_plot.index >= pd.Timestamp('1999-02-01')]
+@memoize(maxsize=4)
+def clean_gpr(raw):
 
-# restrict to countries of interest
-df_gpr_plot = df_gpr_plot[['GPR','GPRC_CHN','GPRC_TWN','GPRC_HKG']]
+    # cut NaNs, start from 2000
+    df_gpr_plot = raw['gpr']
+    df_gpr_plot = df_gpr_plot.set_index('month')
+    df_gpr_plot = df_gpr_plot[~df_gpr_plot['GPRC_CHN'].isna()]
+    df_gpr_plot = df_gpr_plot[df_gpr_plot.index >= pd.Timestamp('1999-02-01')]
 
-# compute moving averages
-df_gpr_mavg = df_gpr_plot.rolling(12).mean()
-df_gpr_mavg = df_gpr_mavg.dropna()
+    # restrict to countries of interest
+    df_gpr_plot = df_gpr_plot[['GPR','GPRC_CHN','GPRC_TWN','GPRC_HKG']]
 
+    # compute moving averages
+    df_gpr_mavg = df_gpr_plot.rolling(12).mean()
+    df_gpr_mavg = df_gpr_mavg.dropna()
 
+    return {'gpr_mavg': df_gpr_mavg}
 
 
 
-#%% figures
+# cleaned datasets: name -> (cleaner, raw inputs it needs)
+datasets = {'investment': (clean_investment, ['imf']),
+            'pension_totals': (clean_pension_totals, ['pension_assets', 'exrate', 'pension_gdp', 'deflator', 'population']),
+            'pension_gdp': (clean_pension_gdp, ['pension_gdp']),
+            'asset_class': (clean_asset_class, ['oecd_struct']),
+            'gpr': (clean_gpr, ['gpr'])}
+
+
 
 
-# Set font family globally
-plt.rcParams['font.family'] = 'Geneva'
+
+#%% figures
+
 
 # define initial color scheme for all graphs
 init_color = 'Set2'
@@ -507,266 +769,599 @@ deu_color = '#595959'
 fra_color = '#1F2E7A'
 itl_color = '#D0E1E1'
 
+
+# always make Canada red, fade the other G7 lines
+def color_g7_lines(ax):
+    for line in ax.get_lines():
+        if line.get_label() == 'Canada':
+            line.set_color(can_color)
+            line.set_alpha(1)
+        if line.get_label() == 'United States':
+            line.set_color(usa_color)
+            line.set_alpha(0.35)
+        if line.get_label() == 'United Kingdom':
+            line.set_color(gbr_color)
+            line.set_alpha(0.35)
+        if line.get_label() == 'Japan':
+            line.set_color(jpn_color)
+            line.set_alpha(0.6)
+        if line.get_label() == 'Germany':
+            line.set_color(deu_color)
+            line.set_alpha(0.35)
+        if line.get_label() == 'France':
+            line.set_color(fra_color)
+            line.set_alpha(0.35)
+        if line.get_label() == 'Italy':
+            line.set_color(itl_color)
+            line.set_alpha(1)
+
+
+
 # (1) total assets anywhere 
-fig, ax = plt.subplots(figsize=(8,5))
-df_totalinv.drop(columns='United States').plot(ax=ax,
-                 lw=4,
-                 alpha=0.4,
-                 colormap=init_color)
-# always make Canada red
-for line in ax.get_lines():
-    if line.get_label() == 'Canada':
-        line.set_color(can_color)
-        line.set_alpha(1)
-    if line.get_label() == 'United States':
-        line.set_color(usa_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'United Kingdom':
-        line.set_color(gbr_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'Japan':
-        line.set_color(jpn_color)
-        line.set_alpha(0.6)
-    if line.get_label() == 'Germany':
-        line.set_color(deu_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'France':
-        line.set_color(fra_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'Italy':
-        line.set_color(itl_color)
-        line.set_alpha(1)
-# plot
-plt.legend(fontsize=8, framealpha=1, borderpad=0.75)
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Total assets issued abroad (foreign assets)", x=0.35, y=1, fontsize=14, fontweight='heavy')
-plt.title("Trillions of USD", x=0.047, y=1.035, fontsize=10)
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("Tot. Foreign Assets, trillions of USD", labelpad=ypad)
-ax.text(x=0.1, y=-0.03, s="""Source: IMF Coordinated Portfolio Investment Survey""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-ax.set_xticklabels(df_share_in_china.index.get_level_values(0))
-plt.show()
-fig.savefig(os.path.join(output_path, "total_foreign_assets.png"), dpi=300, bbox_inches='tight')
+def plot_total_foreign_assets(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['totalinv'].drop(columns='United States').plot(ax=ax,
+                         lw=4,
+                         alpha=0.4,
+                         colormap=init_color)
+    color_g7_lines(ax)
+    # plot
+    plt.legend(fontsize=8, framealpha=1, borderpad=0.75)
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Total assets issued abroad (foreign assets)", x=0.35, y=1, fontsize=14, fontweight='heavy')
+    plt.title("Trillions of USD", x=0.047, y=1.035, fontsize=10)
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("Tot. Foreign Assets, trillions of USD", labelpad=ypad)
+    ax.text(x=0.1, y=-0.03, s="""Source: IMF Coordinated Portfolio Investment Survey""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.set_xticklabels(data['share_in_china'].index.get_level_values(0))
+    return fig
 
 
 
 # (2) total assets in China
-fig, ax = plt.subplots(figsize=(8,5))
-df_inv_in_china.drop(columns='United States').plot(ax=ax,
-                     lw=4,
-                     alpha=0.4,
-                     colormap=init_color)
-# always make Canada red
-for line in ax.get_lines():
-    if line.get_label() == 'Canada':
-        line.set_color(can_color)
-        line.set_alpha(1)
-    if line.get_label() == 'United States':
-        line.set_color(usa_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'United Kingdom':
-        line.set_color(gbr_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'Japan':
-        line.set_color(jpn_color)
-        line.set_alpha(0.6)
-    if line.get_label() == 'Germany':
-        line.set_color(deu_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'France':
-        line.set_color(fra_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'Italy':
-        line.set_color(itl_color)
-        line.set_alpha(1)
-# plot
-plt.legend(fontsize=8, framealpha=1, borderpad=0.75)
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Investment in Chinese assets", x=0.252, y=1, fontsize=14, fontweight='heavy')
-plt.title("Billions of USD", x=0.021, y=1.035, fontsize=10)
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("Assets, billions of USD", labelpad=ypad)
-ax.text(x=0.08, y=-0.03, s="""Source: IMF Coordinated Portfolio Investment Survey""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-ax.set_xticklabels(df_share_in_china.index.get_level_values(0))
-plt.show()
-fig.savefig(os.path.join(output_path, "chinese_assets.png"), dpi=300, bbox_inches='tight')
+def plot_chinese_assets(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['inv_in_china'].drop(columns='United States').plot(ax=ax,
+                             lw=4,
+                             alpha=0.4,
+                             colormap=init_color)
+    color_g7_lines(ax)
+    # plot
+    plt.legend(fontsize=8, framealpha=1, borderpad=0.75)
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Investment in Chinese assets", x=0.252, y=1, fontsize=14, fontweight='heavy')
+    plt.title("Billions of USD", x=0.021, y=1.035, fontsize=10)
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("Assets, billions of USD", labelpad=ypad)
+    ax.text(x=0.08, y=-0.03, s="""Source: IMF Coordinated Portfolio Investment Survey""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.set_xticklabels(data['share_in_china'].index.get_level_values(0))
+    return fig
 
 
 
 # (3) share of assets in China
-fig, ax = plt.subplots(figsize=(8,5))
-df_share_in_china.drop(columns='United Kingdom').plot(ax=ax,
-                       lw=4,
-                       alpha=0.4,
-                       colormap=init_color)
-# always make Canada red
-for line in ax.get_lines():
-    if line.get_label() == 'Canada':
-        line.set_color(can_color)
-        line.set_alpha(1)
-    if line.get_label() == 'United States':
-        line.set_color(usa_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'United Kingdom':
-        line.set_color(gbr_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'Japan':
-        line.set_color(jpn_color)
-        line.set_alpha(0.6)
-    if line.get_label() == 'Germany':
-        line.set_color(deu_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'France':
-        line.set_color(fra_color)
-        line.set_alpha(0.35)
-    if line.get_label() == 'Italy':
-        line.set_color(itl_color)
-        line.set_alpha(1)
-# plot      
-plt.legend(fontsize=8, framealpha=1, borderpad=0.75)
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Share of foreign assets issued in China", x=0.315, y=1, fontsize=14, fontweight='heavy')
-plt.title("% of foreign-issued assets", x=0.095, y=1.035, fontsize=10)
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("% of Foreign Assets", labelpad=ypad)
-ax.text(x=0.084, y=-0.03, s="""Source: IMF Coordinated Portfolio Investment Survey""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-ax.set_xticklabels(df_share_in_china.index.get_level_values(0))
-plt.show()
-fig.savefig(os.path.join(output_path, "share_of_foreign_assets_china.png"), dpi=300, bbox_inches='tight')
+def plot_share_of_foreign_assets_china(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['share_in_china'].drop(columns='United Kingdom').plot(ax=ax,
+                               lw=4,
+                               alpha=0.4,
+                               colormap=init_color)
+    color_g7_lines(ax)
+    # plot      
+    plt.legend(fontsize=8, framealpha=1, borderpad=0.75)
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Share of foreign assets issued in China", x=0.315, y=1, fontsize=14, fontweight='heavy')
+    plt.title("% of foreign-issued assets", x=0.095, y=1.035, fontsize=10)
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("% of Foreign Assets", labelpad=ypad)
+    ax.text(x=0.084, y=-0.03, s="""Source: IMF Coordinated Portfolio Investment Survey""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.set_xticklabels(data['share_in_china'].index.get_level_values(0))
+    return fig
 
 
 
 # bond holdings over time for Canada
-fig, ax = plt.subplots(figsize=(8,5))
-df_bond_holdings['Canada'].plot(ax=ax,
-                                color=can_color,
-                                lw=line_width)
-
-ax.text(x=0.09, y=-0.01, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Bond holdings of Canadian pensions", x=0.3, y=1, fontsize=14, fontweight='heavy')
-plt.title("% of assets", x=0.02, y=1.035, fontsize=10)
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("% of Assets", labelpad=ypad)
-plt.show()
-fig.savefig(os.path.join(output_path, "canada_bond_holdings.png"), dpi=300, bbox_inches='tight')
+def plot_canada_bond_holdings(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['bond_holdings']['Canada'].plot(ax=ax,
+                                         color=can_color,
+                                         lw=line_width)
 
+    ax.text(x=0.09, y=-0.01, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Bond holdings of Canadian pensions", x=0.3, y=1, fontsize=14, fontweight='heavy')
+    plt.title("% of assets", x=0.02, y=1.035, fontsize=10)
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("% of Assets", labelpad=ypad)
+    return fig
 
 
 
 # cash holdings over time for Canada
-fig, ax = plt.subplots(figsize=(8,5))
-df_cash_holdings['Canada'].plot(ax=ax,
-                                color=can_color,
-                                lw=line_width)
-
-ax.text(x=0.09, y=-0.01, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-ax.set_xticklabels(df_share_in_china.index.get_level_values(0))
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Cash holdings of Canadian pensions", x=0.3, y=1, fontsize=14, fontweight='heavy')
-plt.title("% of assets", x=0.02, y=1.035, fontsize=10)
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("% of Assets", labelpad=ypad)
-plt.show()
-fig.savefig(os.path.join(output_path, "canada_cash_holdings.png"), dpi=300, bbox_inches='tight')
-
+def plot_canada_cash_holdings(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['cash_holdings']['Canada'].plot(ax=ax,
+                                         color=can_color,
+                                         lw=line_width)
 
+    ax.text(x=0.09, y=-0.01, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.set_xticklabels(data['share_in_china'].index.get_level_values(0))
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Cash holdings of Canadian pensions", x=0.3, y=1, fontsize=14, fontweight='heavy')
+    plt.title("% of assets", x=0.02, y=1.035, fontsize=10)
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("% of Assets", labelpad=ypad)
+    return fig
 
 
 
 # China geopolitical risk, moving average
-fig, ax = plt.subplots(figsize=(8,5))
+def plot_geopolitical_risk_index_china(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+
+    data['gpr_mavg']['GPRC_CHN'].plot(ax=ax,
+                                      color='#1F2E7A', # dark blue
+                                      lw=line_width)
+    data['gpr_mavg']['GPRC_TWN'].plot(ax=ax,
+                                      color='#475ED1', # mid blue
+                                      lw=line_width)
+    data['gpr_mavg']['GPRC_HKG'].plot(ax=ax,
+                                      color='#1DC9A4', # light blue
+                                      lw=line_width)
+
+    ax.text(x=0.08, y=-0.03, s="""Source: Matteo Iacoviello, personal website""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    plt.legend(['China','Taiwan','Hong Kong'],framealpha=1, borderpad=0.6)
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Caldara-Iacoviello GPR index", x=0.245, y=1, fontsize=14, fontweight='heavy')
+    plt.title("% of articles mentioning adverse events", x=0.163, y=1.035, fontsize=10)
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("% of Articles", labelpad=ypad)
+    return fig
 
-df_gpr_mavg['GPRC_CHN'].plot(ax=ax,
-                             color='#1F2E7A', # dark blue
-                             lw=line_width)
-df_gpr_mavg['GPRC_TWN'].plot(ax=ax,
-                             color='#475ED1', # mid blue
-                             lw=line_width)
-df_gpr_mavg['GPRC_HKG'].plot(ax=ax,
-                             color='#1DC9A4', # light blue
-                             lw=line_width)
 
-ax.text(x=0.08, y=-0.03, s="""Source: Matteo Iacoviello, personal website""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-plt.legend(['China','Taiwan','Hong Kong'],framealpha=1, borderpad=0.6)
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Caldara-Iacoviello GPR index", x=0.245, y=1, fontsize=14, fontweight='heavy')
-plt.title("% of articles mentioning adverse events", x=0.163, y=1.035, fontsize=10)
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("% of Articles", labelpad=ypad)
-plt.show()
-fig.savefig(os.path.join(output_path, "geopolitical_risk_index_china.png"), dpi=300, bbox_inches='tight')
 
+# total pension assets as percent of GDP over time
+def plot_canada_pension_assets_perc_gdp(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['pens_gdp_clean'][['Canada']].plot(ax=ax,
+                                            lw=line_width,
+                                            alpha=0.4,
+                                            colormap=init_color)
+    color_g7_lines(ax)
+    # plot
+    plt.legend('',frameon=False)
+    plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
+    plt.suptitle("Canadian pension assets as % of GDP", x=0.3, y=0.965, fontsize=14, fontweight='black')
+    plt.xlabel("Year", labelpad=xpad)
+    #plt.ylabel("% of GDP", labelpad=ypad)
+    ax.text(x=0.08, y=-0.01, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    return fig
 
 
 
-# total pension assets as percent of GDP over time
-fig, ax = plt.subplots(figsize=(8,5))
-df_pens_gdp_clean[['Canada']].plot(ax=ax,
-                                   lw=line_width,
-                                   alpha=0.4,
-                                   colormap=init_color)
-# always make Canada red
-for line in ax.get_lines():
-    if line.get_label() == 'Canada':
-        line.set_color(can_color)
-        line.set_alpha(1)
-# plot
-plt.legend('',frameon=False)
-plt.grid(color = 'gray', axis='y', linestyle = '--', linewidth = 0.5)
-plt.suptitle("Canadian pension assets as % of GDP", x=0.3, y=0.965, fontsize=14, fontweight='black')
-plt.xlabel("Year", labelpad=xpad)
-#plt.ylabel("% of GDP", labelpad=ypad)
-ax.text(x=0.08, y=-0.01, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['left'].set_visible(False)
-ax.spines['right'].set_visible(False)
-plt.show()
-fig.savefig(os.path.join(output_path, "\canada_pension_assets_perc_gdp.png"), dpi=300, bbox_inches='tight')
+# pension asset structure for various countries (bar charts)
+def plot_pension_asset_structure_2021(data):
+    fig, ax = plt.subplots(figsize=(8,5))
+    data['g7_assets_2021'].plot(ax=ax,
+                                x = 'country',
+                                kind = 'barh',
+                                stacked = True,
+                                mark_right = True,
+                                edgecolor = 'black',
+                                linewidth = 0.2,
+                                color=['#141F52','#D6DBF5','#475ED1','#D2F9F0','#1DC9A4'])
+
+    # set bar colors
+    plt.suptitle("% of pension allocation", x=0.258, y=1.04, fontsize=14, fontweight='black')
+    plt.legend(ncol=5, loc=(0, 1.05), columnspacing=0.8)
+    plt.ylabel("", labelpad=0)
+    ax.text(x=0.12, y=0, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.text(x=0.12, y=-0.03, s="""*Only classes of non-mutual fund holdings are shown""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['bottom'].set_visible(False)
+    ax.yaxis.tick_right()
+    ax.tick_params(axis=u'both', which=u'both', length=0)
+    ax.tick_params(axis='y', pad=-10)
+    return fig
+
+
+
+# figures: output file name -> (plot function, datasets it needs)
+figures = {'total_foreign_assets': (plot_total_foreign_assets, ['investment']),
+           'chinese_assets': (plot_chinese_assets, ['investment']),
+           'share_of_foreign_assets_china': (plot_share_of_foreign_assets_china, ['investment']),
+           'canada_bond_holdings': (plot_canada_bond_holdings, ['asset_class']),
+           'canada_cash_holdings': (plot_canada_cash_holdings, ['asset_class', 'investment']),
+           'geopolitical_risk_index_china': (plot_geopolitical_risk_index_china, ['gpr']),
+           'canada_pension_assets_perc_gdp': (plot_canada_pension_assets_perc_gdp, ['pension_gdp']),
+           'pension_asset_structure_2021': (plot_pension_asset_structure_2021, ['asset_class'])}
+
+
+
+
+
+#%% pipeline
+
+
+# {key: frame} mapping that pickles its oldest frames to spill_dir once it holds more than budget bytes
+class VintageStore(MutableMapping):
+
+    def __init__(self, name, budget=None, spill_dir=None):
+        self.name = name
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.frames = OrderedDict()
+        self.spilled = {}
+        self.sizes = {}
+        self.fingerprints = {}
+        self.nbytes = 0
+
+    def __setitem__(self, key, df):
+        if key in self.sizes:
+            del self[key]
+        self.fingerprints[key] = fingerprint(df)
+        self.sizes[key] = int(df.memory_usage(deep=True).sum())
+        self.frames[key] = df
+        self.nbytes += self.sizes[key]
+        self.spill()
+
+    def __getitem__(self, key):
+        if key in self.frames:
+            return self.frames[key]
+        return pd.read_pickle(self.spilled[key])
+
+    def __delitem__(self, key):
+        if key in self.frames:
+            del self.frames[key]
+            self.nbytes -= self.sizes[key]
+        else:
+            os.remove(self.spilled.pop(key))
+        del self.sizes[key]
+        del self.fingerprints[key]
+
+    def __iter__(self):
+        return iter(self.sizes)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    # write frames to disk, oldest first, until the in-memory ones fit the budget
+    def spill(self):
+        while self.budget is not None and self.nbytes > self.budget and self.frames:
+            key, df = self.frames.popitem(last=False)
+            parts = key if isinstance(key, tuple) else (key,)
+            path = os.path.join(self.spill_dir, '_'.join([self.name] + [str(part) for part in parts]) + ".pkl")
+            os.makedirs(self.spill_dir, exist_ok=True)
+            df.to_pickle(path)
+            self.spilled[key] = path
+            self.nbytes -= self.sizes[key]
+
+    # memoization key built from the fingerprints taken on insertion, without reloading spilled frames
+    def fingerprint(self):
+        return ('store', self.name) + tuple((key, self.fingerprints[key]) for key in sorted(self.sizes))
+
+
+
+# read one raw file, reusing its pickle in cache_dir for the same file, size, mtime and parser version
+def read_source(reader, path, cache_dir=None, cleaner=None):
+
+    # when streaming, clean straight away and skip the memoized wrappers so no raw frame is kept
+    if cleaner is not None:
+        reader = getattr(reader, '__wrapped__', reader)
+        cleaner = getattr(cleaner, '__wrapped__', cleaner)
+    stages = reader.__name__ if cleaner is None else f"{reader.__name__}.{cleaner.__name__}"
+
+    if cache_dir is not None:
+        key = repr((file_fingerprint(path), stages, parser_version)).encode()
+        digest = hashlib.blake2b(key, digest_size=8).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(path)}.{stages}.{digest}.pkl")
+        if os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+
+    df = reader(path)
+    if cleaner is not None:
+        df = cleaner(df)
+
+    # replace the pickles of older versions of this file, matching the digest length so other stages are kept
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        pattern = f"{glob.escape(os.path.basename(path))}.{stages}.{'?' * 16}.pkl"
+        for stale in glob.glob(os.path.join(glob.escape(cache_dir), pattern)):
+            if stale != cache_path:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+        df.to_pickle(cache_path)
+    return df
 
 
 
-    
+# read every file of the named raw inputs, over `jobs` worker processes
+# with stream=True each vintage is cleaned as it is read and only the cleaned frame is stored
+def ingest(data_dir, names, jobs=1, cache_dir=None, stream=False, budget=None, spill_dir=None):
+
+    # one task per file: (input name, key within the input, reader, path, cleaner)
+    tasks = []
+    raw = {}
+    for name in names:
+        reader, files = sources[name]
+        if name in optional_sources and not os.path.exists(os.path.join(data_dir, files)):
+            continue
+        if isinstance(files, dict):
+            cleaner = vintage_cleaners.get(name) if stream else None
+            raw[name] = VintageStore(name, budget, spill_dir) if cleaner is not None else {}
+            for key, file in files.items():
+                tasks.append((name, key, reader, os.path.join(data_dir, file), cleaner))
+        else:
+            tasks.append((name, None, reader, os.path.join(data_dir, files), None))
+
+    # store each frame as it arrives so a spilling store never holds more than its budget
+    def collect(frames):
+        for (name, key, _, _, _), df in zip(tasks, frames):
+            if key is None:
+                raw[name] = df
+            else:
+                raw[name][key] = df
+
+    args = ([task[2] for task in tasks], [task[3] for task in tasks], [cache_dir] * len(tasks), [task[4] for task in tasks])
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            collect(pool.map(read_source, *args))
+    else:
+        collect(map(read_source, *args))
+
+    return raw
+
+
+
+# raw inputs the named datasets are built from, in order of first use
+def needed_sources(names):
+    source_names = []
+    for name in names:
+        source_names += [dep for dep in datasets[name][1] if dep not in source_names]
+    return source_names
+
+
+
+# identity of everything a dataset is built from: this script, the parser version and its raw files
+def dataset_inputs(data_dir, name):
+    inputs = [file_fingerprint(os.path.realpath(__file__)), parser_version]
+    for dep in datasets[name][1]:
+        _, files = sources[dep]
+        for file in (files.values() if isinstance(files, dict) else [files]):
+            path = os.path.join(data_dir, file)
+            inputs.append(file_fingerprint(path) if os.path.exists(path) else ('missing', file))
+    return tuple(inputs)
+
 
-# pension asset structure for various countries (bar charts)
-fig, ax = plt.subplots(figsize=(8,5))
-df_g7_assets_2021.plot(ax=ax,
-                       x = 'country',
-                       kind = 'barh',
-                       stacked = True,
-                       mark_right = True,
-                       edgecolor = 'black',
-                       linewidth = 0.2,
-                       color=['#141F52','#D6DBF5','#475ED1','#D2F9F0','#1DC9A4'])
-
-# set bar colors
-plt.suptitle("% of pension allocation", x=0.258, y=1.04, fontsize=14, fontweight='black')
-plt.legend(ncol=5, loc=(0, 1.05), columnspacing=0.8)
-plt.ylabel("", labelpad=0)
-ax.text(x=0.12, y=0, s="""Source: OECD Global Pension Statistics""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.text(x=0.12, y=-0.03, s="""*Only classes of non-mutual fund holdings are shown""", transform=fig.transFigure, ha='left', fontsize=9, alpha=.7)
-ax.spines['right'].set_visible(False)
-ax.spines['top'].set_visible(False)
-ax.spines['bottom'].set_visible(False)
-ax.yaxis.tick_right()
-ax.tick_params(axis=u'both', which=u'both', length=0)
-ax.tick_params(axis='y', pad=-10)
-plt.show()
-fig.savefig(os.path.join(output_path, "pension_asset_structure_2021.png"), dpi=300, bbox_inches='tight')
 
+# run the cleaners of the named datasets, each on just the raw inputs it needs
+# vintages are cleaned here unless ingest already streamed them through their cleaner
+# with datasets_dir set, each dataset's frames are also pickled there with the inputs they came from
+def clean(raw, names, vintages_cleaned=False, data_dir=None, datasets_dir=None):
+    data = {}
+    for name in names:
+        cleaner, deps = datasets[name]
+        inputs = {}
+        for dep in deps:
+            if dep in optional_sources and dep not in raw:
+                continue
+            inputs[dep] = raw[dep]
+            if dep in vintage_cleaners and not vintages_cleaned:
+                inputs[dep] = {key: vintage_cleaners[dep](df) for key, df in raw[dep].items()}
+        frames = cleaner(inputs)
+        data.update(frames)
+
+        if datasets_dir is not None:
+            os.makedirs(datasets_dir, exist_ok=True)
+            saved = {'inputs': dataset_inputs(data_dir, name), 'frames': frames}
+            pd.to_pickle(saved, os.path.join(datasets_dir, f"{name}.pkl"))
+    return data
+
+
+
+# load the named datasets saved by an earlier clean, returning their frames and the names that
+# have to be rebuilt because they were never saved or their inputs changed since
+def load_datasets(names, data_dir, datasets_dir):
+    data = {}
+    stale = []
+    for name in names:
+        path = os.path.join(datasets_dir, f"{name}.pkl")
+        saved = pd.read_pickle(path) if os.path.exists(path) else None
+        if saved is None or saved['inputs'] != dataset_inputs(data_dir, name):
+            stale.append(name)
+            continue
+        data.update(saved['frames'])
+    return data, stale
+
+
+
+# write every cleaned frame to out_dir/data as csv
+def export(data, out_dir):
+    export_dir = os.path.join(out_dir, "data")
+    os.makedirs(export_dir, exist_ok=True)
+    for name, df in data.items():
+        df.to_csv(os.path.join(export_dir, f"{name}.csv"))
+
+
+
+# draw and save the named figures
+def render(data, out_dir, names, show=False):
+
+    # Set font family globally
+    plt.rcParams['font.family'] = 'Geneva'
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name in names:
+        plot, _ = figures[name]
+        fig = plot(data)
+        fig.savefig(os.path.join(out_dir, f"{name}.png"), dpi=300, bbox_inches='tight')
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
+
+
+
+# split --only into datasets and figures, adding the datasets each figure needs
+def select(only):
+
+    if not only:
+        return list(datasets), list(figures)
+
+    unknown = [name for name in only if name not in datasets and name not in figures]
+    if unknown:
+        raise ValueError(f"unknown dataset or figure: {', '.join(unknown)}")
+
+    fig_names = [name for name in only if name in figures]
+    data_names = [name for name in only if name in datasets]
+    for name in fig_names:
+        data_names += [dep for dep in figures[name][1] if dep not in data_names]
+
+    # with only datasets picked, render every figure they are enough for
+    if not fig_names:
+        fig_names = [name for name, (_, deps) in figures.items() if set(deps) <= set(data_names)]
+
+    return data_names, fig_names
+
+
+
+# stages run by each command, in order
+# export and render load the saved datasets and only ingest and clean the ones that are missing or stale
+commands = {'ingest': ['ingest'],
+            'clean': ['ingest', 'clean'],
+            'export': ['load', 'ingest', 'clean', 'export'],
+            'render': ['load', 'ingest', 'clean', 'render'],
+            'benchmark': ['ingest', 'clean', 'export', 'render']}
+
+
+# print total, mean and fastest time of every stage
+def print_timings(timings):
+    df = pd.DataFrame(timings, columns=['stage', 'seconds'])
+    table = df.groupby('stage', sort=False)['seconds'].agg(['count', 'sum', 'mean', 'min'])
+    table = table.rename(columns={'count': 'runs', 'sum': 'total (s)', 'mean': 'mean (s)', 'min': 'min (s)'})
+    table.loc['all'] = [len(df), df['seconds'].sum(), np.nan, np.nan]
+    table['runs'] = table['runs'].astype(int)
+    print(table.to_string(float_format=lambda x: f"{x:.3f}", na_rep=''))
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Build the pension and political risk datasets and figures.")
+    parser.add_argument('command', nargs='?', default='render', choices=list(commands),
+                        help="ingest fills the parse cache, clean saves the datasets under OUT_DIR/.cache/datasets, "
+                             "export and render reuse saved datasets whose raw files and script are unchanged "
+                             "and rebuild the rest (default: render)")
+    parser.add_argument('--data-dir', default=data_path, help="directory with the raw imf, oecd and gpr data")
+    parser.add_argument('--out-dir', default=output_path, help="directory for figures and exported data")
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        help=f"datasets ({', '.join(datasets)}) or figures ({', '.join(figures)}) to build")
+    parser.add_argument('--jobs', type=int, default=1, help="worker processes used to read the raw files")
+    parser.add_argument('--cache', choices=['on', 'off'], default='on',
+                        help="reuse parsed raw files and saved datasets under OUT_DIR/.cache and memoized results; "
+                             "off rebuilds everything but still saves the cleaned datasets (benchmark always runs cold)")
+    parser.add_argument('--repeat', type=int, default=3, help="number of cold runs for benchmark")
+    parser.add_argument('--show', action='store_true', help="show figures instead of only saving them")
+    parser.add_argument('--stream', action='store_true',
+                        help="clean each workbook as it is read and drop the raw frame")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help="in-memory limit for the cleaned vintages of EACH multi-file input (imf, oecd_struct), "
+                             "not the whole process; beyond it vintages spill to a temporary directory in OUT_DIR "
+                             "(implies --stream)")
+    args = parser.parse_args(argv)
+
+    global memoize_enabled
+    memoize_enabled = args.cache == 'on'
+
+    try:
+        data_names, fig_names = select(args.only)
+    except ValueError as err:
+        parser.error(str(err))
+
+    if args.command == 'ingest' and args.cache == 'off':
+        parser.error("ingest only fills the parse cache, it cannot run with --cache off")
+
+    cache_dir = os.path.join(args.out_dir, ".cache") if args.cache == 'on' else None
+    datasets_dir = os.path.join(args.out_dir, ".cache", "datasets")
+    stream = args.stream or args.memory_budget is not None
+    budget = int(args.memory_budget * 1024 ** 2) if args.memory_budget is not None else None
+
+    # spilled vintages go to a directory private to this run, removed even if the run fails
+    spill_dir = None
+    if budget is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix=".spill-", dir=args.out_dir)
+
+    # benchmark times cold runs: no pickles or saved datasets on disk and empty memo caches before every repeat
+    if args.command == 'benchmark':
+        cache_dir = None
+        datasets_dir = None
+
+    timings = []
+    try:
+        for _ in range(args.repeat if args.command == 'benchmark' else 1):
+            if args.command == 'benchmark':
+                clear_memoized()
+            data = {}
+            build_names = data_names
+            for stage in commands[args.command]:
+                # nothing to load with --cache off, nothing to ingest or clean once every dataset was loaded
+                if (stage == 'load' and cache_dir is None) or (stage in ('ingest', 'clean') and not build_names):
+                    continue
+                start = time.perf_counter()
+                if stage == 'load':
+                    data, build_names = load_datasets(data_names, args.data_dir, datasets_dir)
+                elif stage == 'ingest':
+                    raw = ingest(args.data_dir, needed_sources(build_names), jobs=args.jobs, cache_dir=cache_dir,
+                                 stream=stream, budget=budget, spill_dir=spill_dir)
+                elif stage == 'clean':
+                    cleaned = clean(raw, build_names, vintages_cleaned=stream,
+                                    data_dir=args.data_dir, datasets_dir=datasets_dir)
+                    if 'alloc' in cleaned:
+                        report_allocations(cleaned['alloc'])
+                    data.update(cleaned)
+                    # release the raw frames, in streaming mode also those held by the reader caches
+                    raw = None
+                    if stream:
+                        for func in raw_memoized:
+                            func.cache_clear()
+                elif stage == 'export':
+                    export(data, args.out_dir)
+                elif stage == 'render':
+                    render(data, args.out_dir, fig_names, show=args.show)
+                timings.append((stage, time.perf_counter() - start))
+
+        print_timings(timings)
+    finally:
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+
+
+
+#%% run
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
 
-    
 
 
 